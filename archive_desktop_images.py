@@ -12,7 +12,10 @@ Mac mini M4 などで実行するたびに、デスクトップ直下の画像
   launchd で登録するか、cron で "0 18 * * * cd /path/to/dir && python3 archive_desktop_images.py"
 """
 
+import errno
+import os
 import shutil
+import unicodedata
 from pathlib import Path
 from datetime import datetime
 
@@ -30,6 +33,23 @@ def get_archive_folder_name() -> str:
     """今日の日付を使ったアーカイブフォルダ名を返す（例: Archive_2026-02-17）"""
     return f"Archive_{datetime.now().strftime('%Y-%m-%d')}"
 
+def name_key(name: str) -> str:
+    """重複判定用のキー（APFS は大文字小文字・濁点の NFC/NFD を区別しないため揃える）"""
+    return unicodedata.normalize("NFC", name).casefold()
+
+def move_file(src: str, dest: str, same_device: bool) -> None:
+    """src を dest に移動する（同一ボリュームなら os.rename の1回で済ませる）"""
+    if same_device:
+        os.rename(src, dest)
+        return
+    try:
+        os.rename(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # 別ボリュームのときだけコピー＋削除にフォールバック
+        shutil.move(src, dest)
+
 def main():
     desktop = get_desktop_path()
     if not desktop.exists():
@@ -40,26 +60,38 @@ def main():
     archive_path = VAULT_BASE / archive_name
     archive_path.parent.mkdir(parents=True, exist_ok=True)  # Inspiration_Vault がなければ作成
     archive_path.mkdir(exist_ok=True)
+    # デスクトップと保存先が同じボリュームか、起動時に1回だけ確認
+    same_device = os.stat(desktop).st_dev == os.stat(archive_path).st_dev
+    # 保存先の既存ファイル名は最初に1回だけ読み、以降の重複判定はメモリ上で行う
+    existing = {name_key(n) for n in os.listdir(archive_path)}
 
     moved_count = 0
-    for path in desktop.iterdir():
-        if not path.is_file():
-            continue
-        if path.suffix.lower() in IMAGE_EXTENSIONS:
-            dest = archive_path / path.name
-            if dest.exists():
+    # os.scandir は getdents の結果に種別を持つので、エントリごとの stat を省ける
+    with os.scandir(desktop) as it:
+        for entry in it:
+            name = entry.name
+            dot = name.rfind(".")
+            if dot <= 0 or name[dot:].lower() not in IMAGE_EXTENSIONS:
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            src = entry.path
+            dest_name = name
+            if name_key(dest_name) in existing:
                 # 同名ファイルがある場合は連番を付ける
-                stem, suffix = path.stem, path.suffix
+                stem, suffix = name[:dot], name[dot:]
                 n = 1
-                while dest.exists():
-                    dest = archive_path / f"{stem}_{n}{suffix}"
+                while name_key(dest_name) in existing:
+                    dest_name = f"{stem}_{n}{suffix}"
                     n += 1
+            dest = os.path.join(archive_path, dest_name)
             try:
-                shutil.move(str(path), str(dest))
-                print(f"移動: {path.name} → Inspiration_Vault/{archive_name}/")
+                move_file(src, dest, same_device)
+                existing.add(name_key(dest_name))
+                print(f"移動: {name} → Inspiration_Vault/{archive_name}/")
                 moved_count += 1
             except OSError as e:
-                print(f"失敗: {path.name} - {e}")
+                print(f"失敗: {name} - {e}")
 
     if moved_count == 0:
         print(f"移動する画像はありませんでした。（Inspiration_Vault/{archive_name} は用意済み）")
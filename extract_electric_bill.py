@@ -13,11 +13,15 @@ API キー: 環境変数 GEMINI_API_KEY を設定するか --api-key で指定
 """
 
 import argparse
-import base64
+import hashlib
 import json
 import os
-import re
+import random
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from io import BytesIO
 from pathlib import Path
 from typing import Optional
@@ -29,7 +33,7 @@ try:
 except ImportError:
     pass  # HEIC 以外ならそのまま
 
-from PIL import Image
+from PIL import Image, ImageOps
 
 try:
     import google.generativeai as genai
@@ -52,61 +56,349 @@ EXTRACT_PROMPT = """この画像は電気料金の請求書（または領収書
 
 読み取れない項目は null にしてください。"""
 
+# Gemini の構造化出力で返させる JSON の形（読み取れない項目は null を許す）
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "使用期間開始": {"type": "string", "nullable": True},
+        "使用期間終了": {"type": "string", "nullable": True},
+        "使用量_kWh": {"type": "number", "nullable": True},
+        "請求金額_円": {"type": "number", "nullable": True},
+    },
+    "required": ["使用期間開始", "使用期間終了", "使用量_kWh", "請求金額_円"],
+}
+
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA,
+    "temperature": 0.0,
+}
+
+
+class RateLimiter:
+    """スレッド間で共有する最小間隔ベースのレート制限（1秒あたり rps 回まで）"""
+
+    def __init__(self, rps: float):
+        self.interval = 1.0 / rps
+        self.lock = threading.Lock()
+        self.next = 0.0
+
+    def acquire(self) -> None:
+        """次の送信枠を予約し、その時刻まで待つ"""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.0, self.next - now)
+            self.next = max(now, self.next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+# 一時的なエラーとみなして再試行する HTTP ステータスと、メッセージ中の目印
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_MARKERS = ("quota", "rate limit", "resource exhausted", "resource_exhausted", "deadline", "unavailable")
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """レート制限・一時的なサーバーエラーなど、再試行すべき例外かを判定する"""
+    if getattr(e, "code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    msg = str(e).lower()
+    return any(marker in msg for marker in RETRYABLE_MARKERS)
+
+
+def _call_with_retry(
+    model,
+    parts: list,
+    limiter: Optional[RateLimiter] = None,
+    max_retries: int = 3,
+    base: float = 2.0,
+):
+    """generate_content を呼び、一時的なエラーなら指数バックオフ（ジッター付き）で再試行する"""
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return model.generate_content(parts)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            time.sleep(base * 2 ** attempt + random.uniform(0, 0.5))
+
+
+# そのまま送れる形式（拡張子 → MIME タイプ）
+PASSTHROUGH_MIME_TYPES = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+
+# 送信前の縮小・再エンコード設定（請求書の OCR ならこの程度で十分）
+DEFAULT_MAX_DIM = 1600
+DEFAULT_JPEG_QUALITY = 85
+# これより大きいファイルは、寸法が小さくても再エンコードして送る
+DEFAULT_MAX_UPLOAD_BYTES = 4 * 1024 * 1024
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# 寸法を持つ JPEG の SOF マーカー（DHT / JPG / DAC の C4・C8・CC を除く）
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_size(f) -> Optional[tuple[int, int]]:
+    """JPEG のマーカーをたどり、SOF セグメントから (幅, 高さ) を読む"""
+    while True:
+        b = f.read(1)
+        while b and b != b"\xff":
+            b = f.read(1)
+        while b == b"\xff":  # マーカー前の埋め草
+            b = f.read(1)
+        if not b:
+            return None
+        marker = b[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # 長さを持たない単独マーカー
+            continue
+        if marker in (0xD9, 0xDA):  # EOI / SOS まで SOF がなかった
+            return None
+        seg = f.read(2)
+        if len(seg) < 2:
+            return None
+        length = int.from_bytes(seg, "big")
+        if marker in _JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            return int.from_bytes(data[3:5], "big"), int.from_bytes(data[1:3], "big")
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def _parse_image_header(f) -> Optional[tuple[str, int, int]]:
+    """ファイルオブジェクトの先頭から JPEG/PNG のヘッダーを読み、(MIME タイプ, 幅, 高さ) を返す"""
+    head = f.read(24)
+    if head.startswith(_PNG_SIGNATURE) and head[12:16] == b"IHDR":
+        return "image/png", int.from_bytes(head[16:20], "big"), int.from_bytes(head[20:24], "big")
+    if head.startswith(b"\xff\xd8"):
+        f.seek(2)
+        size = _jpeg_size(f)
+        if size is not None:
+            return ("image/jpeg",) + size
+    return None
+
 
-def load_image_as_png_bytes(path: Path) -> bytes:
-    """画像を開き（HEIC 対応）、PNG バイト列で返す"""
-    with Image.open(path) as img:
-        if img.mode in ("RGBA", "P"):
+def read_image_header(path: str) -> Optional[tuple[str, int, int]]:
+    """ピクセルをデコードせずに、JPEG/PNG のヘッダーから (MIME タイプ, 幅, 高さ) を返す"""
+    with open(path, "rb") as f:
+        return _parse_image_header(f)
+
+
+def load_image_bytes(
+    path: str,
+    max_dim: int = DEFAULT_MAX_DIM,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+    max_bytes: int = DEFAULT_MAX_UPLOAD_BYTES,
+    data: Optional[bytes] = None,
+) -> tuple[bytes, str]:
+    """画像を送信用のバイト列と MIME タイプで返す
+
+    長辺が max_dim 以下かつ max_bytes 以下の JPEG/PNG は、PIL を通さずそのまま返す。
+    それ以外（大きい画像・HEIC）は長辺 max_dim に縮小して JPEG に変換する。
+    data に読み込み済みのファイル内容を渡すと、ファイルを開き直さずにそれを使う。
+    """
+    if os.path.splitext(path)[1].lower() in PASSTHROUGH_MIME_TYPES:
+        if data is not None:
+            header = _parse_image_header(BytesIO(data))
+            size = len(data)
+        else:
+            header = read_image_header(path)
+            size = os.path.getsize(path)
+        if header is not None:
+            mime_type, width, height = header
+            if max(width, height) <= max_dim and size <= max_bytes:
+                if data is None:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                return data, mime_type
+    with Image.open(BytesIO(data) if data is not None else path) as img:
+        img = ImageOps.exif_transpose(img)  # 再エンコードで EXIF の向き情報が消えるため先に反映
+        if img.mode != "RGB":
             img = img.convert("RGB")
+        img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
         buf = BytesIO()
-        img.save(buf, format="PNG")
-        return buf.getvalue()
+        img.save(buf, format="JPEG", quality=jpeg_quality, optimize=True)
+        return buf.getvalue(), "image/jpeg"
+
+
+def _blob_part(data: bytes, mime_type: str) -> dict:
+    """Part.from_bytes がない SDK（google-generativeai）向けに、bytes のままの inline_data を組み立てる"""
+    return {"inline_data": {"mime_type": mime_type, "data": data}}
+
+
+def resolve_part_builder():
+    """SDK が受け取れる画像パートの組み立て関数を返す（起動時に1回だけ判定）"""
+    part_cls = getattr(genai.types, "Part", None)
+    if part_cls is not None and hasattr(part_cls, "from_bytes"):
+        return part_cls.from_bytes
+    return _blob_part
 
 
 def extract_json_from_response(text: str) -> Optional[dict]:
     """応答テキストから JSON ブロックを1つ取り出す"""
-    # コードブロックがあればその中身
-    m = re.search(r"```(?:json)?\s*([\s\S]*?)\s*```", text)
-    if m:
-        try:
-            return json.loads(m.group(1).strip())
-        except json.JSONDecodeError:
-            pass
-    # そのまま {} のブロックを探す
-    m = re.search(r"\{[\s\S]*\}", text)
-    if m:
+    # 構造化出力（GENERATION_CONFIG）により通常は応答全体がそのまま JSON
+    try:
+        out = json.loads(text.strip())
+        if isinstance(out, dict):
+            return out
+    except json.JSONDecodeError:
+        pass
+    # 念のため、最初の { から最後の } までを切り出して読む
+    start, end = text.find("{"), text.rfind("}")
+    if 0 <= start < end:
         try:
-            return json.loads(m.group(0))
+            return json.loads(text[start:end + 1])
         except json.JSONDecodeError:
             pass
     return None
 
 
+# --prefilter で請求書らしくない画像を除外するしきい値
+PREFILTER_MIN_BYTES = 30_000
+PREFILTER_ASPECT_RANGE = (0.3, 3.3)
+
+
+def _looks_like_bill(path: str) -> bool:
+    """ファイルサイズと縦横比だけで、請求書の写真としてありえるかを手早く判定する"""
+    if os.path.getsize(path) <= PREFILTER_MIN_BYTES:
+        return False
+    header = read_image_header(path)
+    if header is not None:
+        _, width, height = header
+    else:
+        with Image.open(path) as img:  # HEIC など（ヘッダーだけ読み、ピクセルはデコードしない）
+            width, height = img.size
+    low, high = PREFILTER_ASPECT_RANGE
+    return height > 0 and low <= width / height <= high
+
+
+# 抽出済み結果のキャッシュ（抽出条件 + 画像ファイルの SHA-256 → 抽出結果）
+CACHE_PATH = Path.home() / ".cache" / "extract_electric_bill.json"
+
+
+def cache_namespace(model_name: str, max_dim: int, jpeg_quality: int) -> str:
+    """結果に影響する条件（モデル・プロンプト・スキーマ・縮小設定）をキャッシュキーの接頭辞にまとめる"""
+    spec = EXTRACT_PROMPT + json.dumps(RESPONSE_SCHEMA, ensure_ascii=False, sort_keys=True)
+    spec_hash = hashlib.sha256(spec.encode("utf-8")).hexdigest()[:16]
+    return f"{model_name}:{spec_hash}:{max_dim}:{jpeg_quality}"
+
+
+class ResultCache:
+    """画像の内容ハッシュをキーに抽出結果を覚えておき、再実行時の API 呼び出しを省く
+
+    read=False のときは読み出しをせず、新しい結果で上書きだけする（キャッシュの更新用）。
+    """
+
+    def __init__(self, path: Path, namespace: str, read: bool = True):
+        self.path = path
+        self.namespace = namespace
+        self.read = read
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            self.data = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self.data = {}
+        if not isinstance(self.data, dict):
+            self.data = {}
+
+    def get(self, digest: str) -> Optional[dict]:
+        if not self.read:
+            return None
+        with self.lock:
+            return self.data.get(f"{self.namespace}:{digest}")
+
+    def put(self, digest: str, value: dict) -> None:
+        with self.lock:
+            self.data[f"{self.namespace}:{digest}"] = value
+            self.dirty = True
+
+    def save(self) -> None:
+        """一時ファイルに書いてから置き換える（途中で止まっても壊れたキャッシュを残さない）
+
+        書き込めなくても抽出結果の出力は止めず、警告だけ出す。
+        """
+        if not self.dirty:
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with self.lock:
+                tmp.write_text(json.dumps(self.data, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"警告: キャッシュを保存できませんでした（{self.path}）: {e}", file=sys.stderr)
+
+
 def extract_from_image_path(
-    path: Path,
+    path: str,
     model,
+    part_builder,
+    limiter: Optional[RateLimiter] = None,
+    max_dim: int = DEFAULT_MAX_DIM,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+    cache: Optional[ResultCache] = None,
+    prefilter: bool = False,
 ) -> dict:
     """1枚の画像を Gemini に送り、抽出結果の dict を返す"""
-    png_bytes = load_image_as_png_bytes(path)
-    # SDK が受け取る形式（base64 または bytes は実装依存のため両対応）
-    try:
-        image_part = genai.types.Part.from_bytes(data=png_bytes, mime_type="image/png")
-    except (AttributeError, TypeError):
-        image_part = {
-            "inline_data": {
-                "mime_type": "image/png",
-                "data": base64.b64encode(png_bytes).decode("ascii"),
-            }
-        }
-    response = model.generate_content([EXTRACT_PROMPT, image_part])
+    name = os.path.basename(path)
+    if prefilter and not _looks_like_bill(path):
+        return {"_file": name, "_skipped": "heuristic"}
+    data = None
+    if cache is not None:
+        # 縮小前のファイル内容でキーを作るので、同じ画像ならファイル名が変わってもヒットする
+        # （読んだ内容はそのまま load_image_bytes に渡し、ファイルを2回読まない）
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        cached = cache.get(digest)
+        if cached is not None:
+            return {**cached, "_file": name}
+    image_bytes, mime_type = load_image_bytes(path, max_dim, jpeg_quality, data=data)
+    image_part = part_builder(data=image_bytes, mime_type=mime_type)
+    response = _call_with_retry(model, [EXTRACT_PROMPT, image_part], limiter)
     if not response or not response.text:
-        return {"_file": path.name, "_error": "空の応答"}
+        return {"_file": name, "_error": "空の応答"}
     raw = response.text.strip()
     out = extract_json_from_response(raw)
     if out is None:
-        return {"_file": path.name, "_raw": raw[:200], "_error": "JSON 解析失敗"}
-    out["_file"] = path.name
-    return out
+        return {"_file": name, "_raw": raw[:200], "_error": "JSON 解析失敗"}
+    # 全項目 null（読み取れなかった）の結果は覚えず、次回また抽出し直す
+    if cache is not None and any(out.get(k) is not None for k in RESPONSE_SCHEMA["properties"]):
+        cache.put(digest, out)
+    return {**out, "_file": name}
+
+
+class ResultWriter:
+    """抽出結果を1件ずつファイルに書き出す（.jsonl は1行1件、それ以外は JSON 配列）"""
+
+    def __init__(self, path: str):
+        self.jsonl = path.lower().endswith(".jsonl")
+        self.f = open(path, "w", encoding="utf-8")
+        self.count = 0
+        if not self.jsonl:
+            self.f.write("[")
+
+    def write(self, row: dict) -> None:
+        """1件追記してすぐ flush する（途中で止まっても書けた分は残る）"""
+        if self.jsonl:
+            self.f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        else:
+            self.f.write(("," if self.count else "") + "\n  " + json.dumps(row, ensure_ascii=False))
+        self.count += 1
+        self.f.flush()
+
+    def close(self) -> None:
+        if not self.jsonl:
+            self.f.write("\n]\n" if self.count else "]\n")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def main():
@@ -136,10 +428,63 @@ def main():
     )
     parser.add_argument(
         "-o", "--output",
-        help="結果を書き出す JSON ファイルパス（未指定時は標準出力のみ）",
+        help="結果を書き出すファイルパス（.jsonl なら1行1件、それ以外は JSON 配列。未指定時は標準出力のみ）",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Gemini へ同時に送るリクエスト数（デフォルト: 4）",
+    )
+    parser.add_argument(
+        "--rps",
+        type=float,
+        default=1.0,
+        help="Gemini への1秒あたりの最大リクエスト数（デフォルト: 1.0、0 で制限なし）",
+    )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"抽出結果のキャッシュ（{CACHE_PATH}）を読み書きせずに全画像を処理する",
+    )
+    cache_group.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="キャッシュを読まずに全画像を処理し、結果でキャッシュを更新する",
+    )
+    parser.add_argument(
+        "--prefilter",
+        action="store_true",
+        help="小さすぎる・極端に細長い画像を請求書ではないとみなし、API に送らずスキップする",
+    )
+    parser.add_argument(
+        "--max-dim",
+        type=int,
+        default=DEFAULT_MAX_DIM,
+        help=f"送信前に縮小する長辺の最大ピクセル数（デフォルト: {DEFAULT_MAX_DIM}）",
+    )
+    parser.add_argument(
+        "--jpeg-quality",
+        type=int,
+        default=DEFAULT_JPEG_QUALITY,
+        help=f"縮小・変換時の JPEG 品質 1〜95（デフォルト: {DEFAULT_JPEG_QUALITY}）",
     )
     args = parser.parse_args()
 
+    if args.concurrency < 1:
+        print("エラー: --concurrency は 1 以上を指定してください。", file=sys.stderr)
+        return 1
+    if args.rps < 0:
+        print("エラー: --rps は 0 以上を指定してください。", file=sys.stderr)
+        return 1
+    if args.max_dim < 1:
+        print("エラー: --max-dim は 1 以上を指定してください。", file=sys.stderr)
+        return 1
+    if not 1 <= args.jpeg_quality <= 95:
+        print("エラー: --jpeg-quality は 1〜95 で指定してください。", file=sys.stderr)
+        return 1
+
     if not args.api_key:
         print("エラー: API キーがありません。--api-key を指定するか GEMINI_API_KEY を設定してください。", file=sys.stderr)
         return 1
@@ -148,7 +493,10 @@ def main():
         print("エラー: google-generativeai がインストールされていません。pip install google-generativeai", file=sys.stderr)
         return 1
 
-    genai.configure(api_key=args.api_key)
+    # gRPC（HTTP/2）で1本の接続を全スレッドで多重化し、呼び出しごとの TLS 接続を避ける
+    genai.configure(api_key=args.api_key, transport="grpc")
+    # 画像パートの組み立て方（Part.from_bytes があればそれ、なければ inline_data の dict）
+    part_builder = resolve_part_builder()
 
     # モデル一覧表示
     if args.list_models:
@@ -168,11 +516,16 @@ def main():
         print(f"エラー: フォルダが見つかりません: {folder}", file=sys.stderr)
         return 1
 
-    image_paths = [
-        p for p in folder.iterdir()
-        if p.is_file() and p.suffix.lower() in IMAGE_EXTENSIONS
-    ]
-    image_paths.sort(key=lambda p: p.name)
+    # os.scandir はエントリの種別をキャッシュしているので、ファイルごとの stat が不要
+    with os.scandir(folder) as it:
+        image_paths = sorted(
+            (
+                entry.path for entry in it
+                if entry.is_file()
+                and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+            ),
+            key=os.path.basename,
+        )
 
     if not image_paths:
         print(f"エラー: 画像ファイル（{', '.join(IMAGE_EXTENSIONS)}）がありません: {folder}", file=sys.stderr)
@@ -184,25 +537,73 @@ def main():
         model_name = model_name.replace("models/", "", 1)
     
     try:
-        model = genai.GenerativeModel(model_name)
+        model = genai.GenerativeModel(model_name, generation_config=GENERATION_CONFIG)
     except Exception as e:
         print(f"エラー: モデル '{model_name}' が見つかりません: {e}", file=sys.stderr)
         print(f"ヒント: --list-models で利用可能なモデルを確認できます", file=sys.stderr)
         return 1
 
-    results = []
-    for path in image_paths:
-        try:
-            row = extract_from_image_path(path, model)
-            results.append(row)
-        except Exception as e:
-            results.append({"_file": path.name, "_error": str(e)})
+    # 並列化しても API のレート上限を超えないよう、全スレッドで1つのリミッタを共有
+    limiter = RateLimiter(args.rps) if args.rps > 0 else None
+
+    # 共有クライアント（gRPC チャネル）はスレッドから同時に初期化されないよう先に作っておく
+    try:
+        from google.generativeai import client as genai_client
+        default_client = genai_client.get_default_generative_client()
+        print(f"接続: {type(default_client.transport).__name__}", file=sys.stderr)
+    except (ImportError, AttributeError):
+        pass
+
+    # 前回までに抽出済みの画像は API を呼ばずに結果を再利用する
+    cache = None if args.no_cache else ResultCache(
+        CACHE_PATH,
+        cache_namespace(model_name, args.max_dim, args.jpeg_quality),
+        read=not args.refresh_cache,
+    )
 
-    json_str = json.dumps(results, ensure_ascii=False, indent=2)
-    print(json_str)
+    # 1枚ごとの API 呼び出しは独立しているので、スレッドで並列に投げる
+    # --output 指定時は、完了した順にファイルへ逐次書き出す
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as ex, \
+                (ResultWriter(args.output) if args.output else nullcontext()) as writer:
+            futs = {
+                ex.submit(
+                    extract_from_image_path,
+                    p,
+                    model,
+                    part_builder,
+                    limiter=limiter,
+                    max_dim=args.max_dim,
+                    jpeg_quality=args.jpeg_quality,
+                    cache=cache,
+                    prefilter=args.prefilter,
+                ): p
+                for p in image_paths
+            }
+            try:
+                for fut in as_completed(futs):
+                    path = futs[fut]
+                    try:
+                        row = fut.result()
+                    except Exception as e:
+                        row = {"_file": os.path.basename(path), "_error": str(e)}
+                    results.append(row)
+                    if writer is not None:
+                        writer.write(row)
+            except BaseException:
+                # Ctrl-C などで中断したら、待ち行列の画像は処理せずすぐに抜ける
+                ex.shutdown(wait=False, cancel_futures=True)
+                raise
+    finally:
+        if cache is not None:
+            cache.save()
+    # 完了順はばらつくので、標準出力はファイル名順にそろえる
+    results.sort(key=lambda r: r["_file"])
+
+    print(json.dumps(results, ensure_ascii=False, indent=2))
 
     if args.output:
-        Path(args.output).write_text(json_str, encoding="utf-8")
         print(f"\n→ 保存しました: {args.output}", file=sys.stderr)
 
     return 0